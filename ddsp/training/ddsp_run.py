@@ -190,6 +190,7 @@ def main(unused_argv):
   if FLAGS.mode == 'train':
     strategy = train_util.get_strategy(tpu=FLAGS.tpu,
                                        cluster_config=FLAGS.cluster_config)
+    train_util.set_precision_policy()
     with strategy.scope():
       model = models.get_model()
       trainer = trainers.get_trainer_class()(model, strategy)
@@ -61,7 +61,9 @@ class Model(tf.keras.Model):
 
   def sum_losses(self, losses_dict):
     """Sum all the scalar losses in a dictionary."""
-    return tf.reduce_sum(list(losses_dict.values()))
+    # Cast to float32, losses can differ in dtype under mixed precision.
+    losses = [tf.cast(loss, tf.float32) for loss in losses_dict.values()]
+    return tf.reduce_sum(losses)
 
   def _update_losses_dict(self, loss_objs, *args, **kwargs):
     """Helper function to run loss objects on args and add to model losses."""
@@ -78,6 +78,21 @@ def get_strategy(tpu='', cluster_config=''):
   return strategy
 
 
+@gin.configurable
+def set_precision_policy(policy=None):
+  """Set the global Keras precision policy, before the model is created.
+
+  Args:
+    policy: Name of a Keras mixed precision policy, such as 'mixed_bfloat16'
+      or 'mixed_float16'. Variables stay in float32 while layers compute in
+      reduced precision. If None, the current policy (float32) is kept. Synths
+      and effects are also Keras layers, so check audio quality when enabling.
+  """
+  if policy is not None:
+    logging.info('Setting precision policy to %s', policy)
+    tf.keras.mixed_precision.set_global_policy(policy)
+
+
 def expand_path(file_path):
   return os.path.expanduser(os.path.expandvars(file_path))
 
@@ -240,8 +255,7 @@ def train(data_provider,
   """
   # Get a distributed dataset iterator.
   dataset = data_provider.get_batch(batch_size, shuffle=True, repeats=-1)
-  dataset = trainer.distribute_dataset(dataset)
-  dataset_iter = iter(dataset)
+  dataset_iter = trainer.make_iterator(dataset)
 
   # Build model, easiest to just run forward pass.
   trainer.build(next(dataset_iter))
@@ -274,7 +288,7 @@ def train(data_provider,
       step = trainer.step
 
       # Take a step.
-      losses = trainer.train_step(dataset_iter)
+      losses = trainer.train_step()
 
       # Create training loss metrics when starting/restarting training.
       if first_step:
@@ -325,6 +339,7 @@ def train(data_provider,
   # Write a final checkpoint.
   if save_dir:
     trainer.save(save_dir)
+    trainer.wait_for_checkpoint()
     summary_writer.flush()
 
   logging.info('Training Finished!')
@@ -14,6 +14,10 @@
 
 """Library of Trainer objects that define traning step and wrap optimizer."""
 
+import concurrent.futures
+import inspect
+import os
+import tempfile
 import time
 
 from absl import logging
@@ -34,7 +38,14 @@ class Trainer(object):
                lr_decay_steps=10000,
                lr_decay_rate=0.98,
                grad_clip_norm=3.0,
-               restore_keys=None):
+               restore_keys=None,
+               jit_compile=False,
+               async_save=True,
+               accum_steps=1,
+               checkpoint_io_device=None,
+               all_reduce_dtype=None,
+               restore_staging_dir=None,
+               optimizer_jit_compile=True):
     """Constructor.
 
     Args:
@@ -47,12 +58,55 @@ class Trainer(object):
       grad_clip_norm: Norm level by which to clip gradients.
       restore_keys: List of names of model properties to restore. If no keys are
         passed, restore the whole model.
+      jit_compile: Compile the per-replica training step with XLA. Opt-in, as
+        every feature in the batch must be numeric (no tf.string features,
+        such as the ids of the URMP MIDI datasets). Leave as False to use the
+        standard graph executor, for instance if XLA runs out of memory.
+      async_save: Snapshot variables to host memory when saving and write the
+        checkpoint files on a background thread, so training is not blocked
+        on file I/O.
+      accum_steps: Number of batches to accumulate gradients over before each
+        optimizer update. Gradients are only reduced across replicas once per
+        update, giving an effective batch size of `accum_steps` batches.
+        Must be >= 1.
+      checkpoint_io_device: Optional device, such as '/job:localhost', through
+        which all checkpoint reads and writes are funneled. Gathers variables
+        from every device into one contiguous write per host, instead of
+        having each device access the filesystem.
+      all_reduce_dtype: Optional dtype, such as 'float16', to compress
+        gradients to for the cross-replica all-reduce. Gradients are cast back
+        to their own dtype before being applied. If None, the optimizer
+        reduces the full precision gradients. 'bfloat16' is not supported by
+        NCCL, so it requires `jit_compile` when training on GPUs.
+      restore_staging_dir: Optional local directory, such as '/dev/shm/ddsp',
+        to copy checkpoint files into with parallel bulk reads before a full
+        restore. Speeds up restoring from network filesystems such as GCS,
+        where reading each variable separately is slow. Each restore stages
+        into a new temporary subdirectory, and the trainer only ever deletes
+        the subdirectory it staged previously.
+      optimizer_jit_compile: Fuse the optimizer's per-variable updates into one
+        XLA kernel, where the optimizer supports it (TF 2.11+). Independent of
+        `jit_compile`, which compiles the whole per-replica step.
     """
+    if accum_steps < 1:
+      raise ValueError(f'accum_steps must be >= 1, got {accum_steps}.')
+
     self.model = model
     self.strategy = strategy
     self.checkpoints_to_keep = checkpoints_to_keep
     self.grad_clip_norm = grad_clip_norm
     self.restore_keys = restore_keys
+    self.jit_compile = jit_compile
+    self.optimizer_jit_compile = optimizer_jit_compile
+    self.accum_steps = accum_steps
+    self.all_reduce_dtype = all_reduce_dtype
+    if (all_reduce_dtype is not None and
+        tf.as_dtype(all_reduce_dtype) == tf.bfloat16 and not jit_compile and
+        'GPU' in self._worker_device_types()):
+      raise ValueError('NCCL all-reduce does not support bfloat16, use '
+                       'all_reduce_dtype=\'float16\' or jit_compile=True.')
+    self.restore_staging_dir = restore_staging_dir
+    self._staged_dir = None
 
     # Create an optimizer.
     lr_schedule = tf.keras.optimizers.schedules.ExponentialDecay(
@@ -61,11 +115,115 @@ class Trainer(object):
         decay_rate=lr_decay_rate)
 
     with self.strategy.scope():
-      self.optimizer = tf.keras.optimizers.Adam(lr_schedule)
+      self.optimizer = self._get_optimizer(lr_schedule)
+    self._apply_kwargs = self._get_apply_kwargs()
+
+    # Forward pass used to build the model, traced once per trainer.
+    self._call_fn = tf.function(self.model.__call__)
+
+    # Per-replica steps. Those taking a batch are compiled in `build`, once the
+    # batch signature is known.
+    self._step_fn = None
+    self._accumulate_step_fn = None
+    self._apply_step_fn = self._compile(self.apply_step_fn)
+
+    # Distributed dataset iterator, created in `make_iterator`.
+    self._iter = None
+
+    # Trainable variables and gradient accumulators, created in `build`.
+    self._trainable_vars = None
+    self._grad_accumulators = None
+    # Which variables get a gradient, recorded when the step is traced.
+    self._has_grad = None
+
+    # Fixed for the life of the strategy, so safe to fold into the graph.
+    self._inv_n_replicas = tf.constant(
+        1.0 / self.strategy.num_replicas_in_sync, dtype=tf.float32)
+
+    # Full model checkpoint and a CheckpointManager per save_dir, built lazily.
+    self._checkpoint = None
+    self._managers = {}
+    self._save_options = self._get_save_options(async_save,
+                                                checkpoint_io_device)
+    self._restore_options = tf.train.CheckpointOptions(
+        experimental_io_device=checkpoint_io_device)
+
+  def _compile(self, fn, input_signature=None):
+    """Wrap a per-replica function in its own tf.function for XLA."""
+    # Without XLA, fn is traced directly into the graph of `train_step`.
+    if self.jit_compile:
+      return tf.function(fn, input_signature=input_signature, jit_compile=True)
+    else:
+      return fn
+
+  def _get_optimizer(self, lr_schedule):
+    """Adam optimizer, fusing the variable updates with XLA if supported."""
+    try:
+      optimizer = tf.keras.optimizers.Adam(
+          lr_schedule, jit_compile=self.optimizer_jit_compile, use_ema=False)
+    except (TypeError, ValueError):
+      # Legacy optimizers don't accept these arguments.
+      optimizer = tf.keras.optimizers.Adam(lr_schedule)
+
+    # Float16 gradients can underflow, so scale the loss (bfloat16 doesn't).
+    if tf.keras.mixed_precision.global_policy().compute_dtype == 'float16':
+      optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+    return optimizer
+
+  def _get_apply_kwargs(self):
+    """Kwargs for `apply_gradients`, skipping aggregation if done manually."""
+    if self.all_reduce_dtype is None:
+      return {}
+    params = inspect.signature(self.optimizer.apply_gradients).parameters
+    if 'skip_gradients_aggregation' in params:
+      return {'skip_gradients_aggregation': True}
+    elif 'experimental_aggregate_gradients' in params:
+      return {'experimental_aggregate_gradients': False}
+    else:
+      raise ValueError('all_reduce_dtype requires an optimizer that can skip '
+                       'gradient aggregation in apply_gradients().')
+
+  @property
+  def _loss_scaling(self):
+    """Whether the optimizer scales the loss for float16 training."""
+    return isinstance(self.optimizer,
+                      tf.keras.mixed_precision.LossScaleOptimizer)
+
+  def _scale_loss(self, loss):
+    """Float32 loss, scaled up if training with float16."""
+    loss = tf.cast(loss, tf.float32)
+    if self._loss_scaling:
+      loss = self.optimizer.get_scaled_loss(loss)
+    return loss
+
+  def _get_grads(self, tape, loss):
+    """Gradients of a `_scale_loss` loss, unscaled before clipping."""
+    grads = tape.gradient(loss, self._trainable_vars)
+    if self._loss_scaling:
+      grads = self.optimizer.get_unscaled_gradients(grads)
+    return grads
+
+  def _get_save_options(self, async_save, io_device=None):
+    """Checkpoint options for `save`, falling back to sync on older TF."""
+    if not async_save:
+      return tf.train.CheckpointOptions(experimental_io_device=io_device)
+    try:
+      return tf.train.CheckpointOptions(
+          experimental_io_device=io_device,
+          experimental_enable_async_checkpoint=True)
+    except TypeError:
+      logging.warning('Async checkpointing is not supported by this version '
+                      'of TensorFlow, saving synchronously.')
+      return tf.train.CheckpointOptions(experimental_io_device=io_device)
 
   def get_checkpoint(self, model=None):
     """Model arg can also be a tf.train.Checkpoint(**dict(submodules))."""
-    model = model or self.model  # Default to full model.
+    if model is None:
+      # Default to full model, reusing the checkpoint object across calls.
+      if self._checkpoint is None:
+        self._checkpoint = tf.train.Checkpoint(model=self.model,
+                                               optimizer=self.optimizer)
+      return self._checkpoint
     return tf.train.Checkpoint(model=model, optimizer=self.optimizer)
 
   def save(self, save_dir):
@@ -73,14 +231,22 @@ class Trainer(object):
     # Saving weights in checkpoint format because saved_model requires
     # handling variable batch size, which some synths and effects can't.
     start_time = time.time()
-    checkpoint = self.get_checkpoint()
-    manager = tf.train.CheckpointManager(
-        checkpoint, directory=save_dir, max_to_keep=self.checkpoints_to_keep)
+    manager = self._managers.get(save_dir)
+    if manager is None:
+      manager = tf.train.CheckpointManager(self.get_checkpoint(),
+                                           directory=save_dir,
+                                           max_to_keep=self.checkpoints_to_keep)
+      self._managers[save_dir] = manager
     step = self.step.numpy()
-    manager.save(checkpoint_number=step)
+    manager.save(checkpoint_number=step, options=self._save_options)
     logging.info('Saved checkpoint to %s at step %s', save_dir, step)
     logging.info('Saving model took %.1f seconds', time.time() - start_time)
 
+  def wait_for_checkpoint(self):
+    """Block until any pending asynchronous checkpoint write has finished."""
+    if self._checkpoint is not None and hasattr(self._checkpoint, 'sync'):
+      self._checkpoint.sync()
+
   def restore(self, checkpoint_path, restore_keys=None):
     """Restore model and optimizer from a checkpoint if it exists.
 
@@ -97,8 +263,8 @@ class Trainer(object):
     # Prefer function args over object properties.
     restore_keys = restore_keys or self.restore_keys
     if restore_keys is None:
-      # If no keys are passed, restore the whole model.
-      model = self.model
+      # If no keys are passed, restore the whole model (cached checkpoint).
+      model = None
       logging.info('Trainer restoring the full model')
     else:
       # Restore only sub-modules by building a new subgraph.
@@ -113,16 +279,51 @@ class Trainer(object):
     # Restore from latest checkpoint.
     checkpoint = self.get_checkpoint(model)
     latest_checkpoint = train_util.get_latest_checkpoint(checkpoint_path)
+    if restore_keys is None and self.restore_staging_dir:
+      latest_checkpoint = self._stage_checkpoint(latest_checkpoint)
     # checkpoint.restore must be within a strategy.scope() so that optimizer
     # slot variables are mirrored.
     with self.strategy.scope():
       if restore_keys is None:
-        checkpoint.restore(latest_checkpoint)
+        checkpoint.restore(latest_checkpoint, options=self._restore_options)
+        self._trainable_vars = list(self.model.trainable_variables)
       else:
-        checkpoint.restore(latest_checkpoint).expect_partial()
+        checkpoint.restore(latest_checkpoint,
+                           options=self._restore_options).expect_partial()
       logging.info('Loaded checkpoint %s', latest_checkpoint)
     logging.info('Loading model took %.1f seconds', time.time() - start_time)
 
+  def _stage_checkpoint(self, checkpoint_prefix):
+    """Copy checkpoint files to `restore_staging_dir`, returns new prefix."""
+    start_time = time.time()
+    name = os.path.basename(checkpoint_prefix)
+
+    # Remove the checkpoint this trainer staged previously, which would
+    # otherwise pile up in host memory on '/dev/shm'. The new one is kept after
+    # restoring, as deferred slot variable restores still read from it.
+    if self._staged_dir is not None:
+      tf.io.gfile.rmtree(self._staged_dir)
+      self._staged_dir = None
+
+    # A unique subdirectory owned by this trainer, as the staging directory
+    # may be shared with other jobs and processes.
+    tf.io.gfile.makedirs(self.restore_staging_dir)
+    staging_dir = tempfile.mkdtemp(prefix=name + '-',
+                                   dir=self.restore_staging_dir)
+    self._staged_dir = staging_dir
+
+    def copy(path):
+      staged_path = os.path.join(staging_dir, os.path.basename(path))
+      tf.io.gfile.copy(path, staged_path, overwrite=True)
+
+    # Index and data shards, e.g. 'ckpt-100.index', 'ckpt-100.data-00000-...'.
+    paths = tf.io.gfile.glob(checkpoint_prefix + '.*')
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+      list(executor.map(copy, paths))
+    logging.info('Staging checkpoint to %s took %.1f seconds',
+                 staging_dir, time.time() - start_time)
+    return os.path.join(staging_dir, name)
+
   @property
   def step(self):
     """The number of training steps completed."""
@@ -132,6 +333,17 @@ class Trainer(object):
     """Sum across processors."""
     return self.strategy.reduce(tf.distribute.ReduceOp.SUM, x, axis=axis)
 
+  def replica_mean(self, losses):
+    """Average scalar losses across replicas with a single all-reduce."""
+    # Keep the reduction in float32, even with mixed precision.
+    stacked_losses = tf.stack(
+        [tf.cast(l, tf.float32) for l in tf.nest.flatten(losses)])
+    replica_ctx = tf.distribute.get_replica_context()
+    sum_losses = replica_ctx.all_reduce(tf.distribute.ReduceOp.SUM,
+                                        stacked_losses)
+    mean_losses = sum_losses * self._inv_n_replicas
+    return tf.nest.pack_sequence_as(losses, tf.unstack(mean_losses))
+
   def run(self, fn, *args, **kwargs):
     """Distribute and run function on processors."""
     return self.strategy.run(fn, args=args, kwargs=kwargs)
@@ -139,9 +351,59 @@ class Trainer(object):
   def build(self, batch):
     """Build the model by running a distributed batch through it."""
     logging.info('Building the model...')
-    _ = self.run(tf.function(self.model.__call__), batch)
+    _ = self.run(self._call_fn, batch)
+    self._trainable_vars = list(self.model.trainable_variables)
+
+    input_signature = self._get_input_signature(batch)
+    self._step_fn = self._compile(self.step_fn, input_signature)
+    self._accumulate_step_fn = self._compile(self.accumulate_step_fn,
+                                             input_signature)
+    if self.accum_steps > 1:
+      self._build_grad_accumulators()
     self.model.summary()
 
+  def _get_input_signature(self, batch):
+    """Per-replica batch signature, so the XLA steps don't silently retrace.
+
+    Args:
+      batch: A (distributed) batch of training data.
+
+    Returns:
+      A list with a nest of tf.TensorSpec with an unknown batch dimension, so
+      partial batches still match. None without XLA, where the step is traced
+      inline, and unless every worker device is a GPU, as other devices call
+      the step with (args, kwargs), which doesn't match.
+    """
+    if not self.jit_compile or self._worker_device_types() != {'GPU'}:
+      return None
+    replica_batch = tf.nest.map_structure(
+        lambda x: self.strategy.experimental_local_results(x)[0], batch)
+    batch_spec = tf.nest.map_structure(
+        lambda t: tf.TensorSpec([None] + t.shape[1:].as_list(), t.dtype),
+        replica_batch)
+    return [batch_spec]
+
+  def _worker_device_types(self):
+    """Set of device types, such as {'GPU'}, the strategy runs replicas on."""
+    try:
+      worker_devices = self.strategy.extended.worker_devices
+    except (AttributeError, RuntimeError):
+      # The default strategy doesn't define its worker devices.
+      return set()
+    return {tf.DeviceSpec.from_string(d).device_type for d in worker_devices}
+
+  def _build_grad_accumulators(self):
+    """Create a local gradient accumulator for each trainable variable."""
+    # ON_READ variables are updated per replica without any cross-replica sync.
+    with self.strategy.scope():
+      self._grad_accumulators = [
+          tf.Variable(tf.zeros(v.shape, v.dtype),
+                      trainable=False,
+                      synchronization=tf.VariableSynchronization.ON_READ,
+                      aggregation=tf.VariableAggregation.SUM)
+          for v in self._trainable_vars
+      ]
+
   def distribute_dataset(self, dataset):
     """Create a distributed dataset."""
     if isinstance(dataset, tf.data.Dataset):
@@ -149,27 +411,135 @@ class Trainer(object):
     else:
       return dataset
 
+  def make_iterator(self, dataset):
+    """Create the distributed dataset iterator consumed by `train_step`."""
+    self._iter = iter(self.distribute_dataset(dataset))
+    return self._iter
+
+  def train_step(self, inputs=None):
+    """Distributed training step.
+
+    Args:
+      inputs: Deprecated, call `make_iterator()` once and pass no inputs
+        instead. A dataset iterator or a single batch to train on.
+
+    Returns:
+      Dictionary of losses, averaged across replicas.
+
+    Raises:
+      ValueError: If `build()` wasn't called, or if no inputs are passed and
+        `make_iterator()` wasn't called.
+    """
+    # The step functions and variable list are only created in `build()`.
+    if self._trainable_vars is None:
+      raise ValueError('Call build() before train_step().')
+
+    if inputs is None:
+      if self._iter is None:
+        raise ValueError('Call make_iterator() before train_step().')
+      # Always the same iterator object, so the step is only traced once.
+      return self._train_step_iter(self._iter)
+
+    logging.log_first_n(
+        logging.WARNING, 'Passing inputs to Trainer.train_step() is '
+        'deprecated, call Trainer.make_iterator() once instead.', 1)
+    # Dispatch on the input type, each has its own tf.function so neither
+    # retraces the other. Iterators are slightly faster, as next() is traced.
+    if hasattr(inputs, '__next__'):
+      return self._train_step_iter(inputs)
+    elif self.accum_steps > 1:
+      raise ValueError('Gradient accumulation requires a dataset iterator, '
+                       'not a single batch.')
+    else:
+      return self._train_step_batch(inputs)
+
   @tf.function
-  def train_step(self, inputs):
-    """Distributed training step."""
-    # Wrap iterator in tf.function, slight speedup passing in iter vs batch.
-    batch = next(inputs) if hasattr(inputs, '__next__') else inputs
-    losses = self.run(self.step_fn, batch)
-    # Add up the scalar losses across replicas.
-    n_replicas = self.strategy.num_replicas_in_sync
-    return {k: self.psum(v, axis=None) / n_replicas for k, v in losses.items()}
+  def _train_step_iter(self, inputs):
+    """Distributed training step on the next batch(es) of an iterator."""
+    if self.accum_steps > 1:
+      return self._accumulated_step(inputs)
+    else:
+      return self._distributed_step(next(inputs))
 
   @tf.function
+  def _train_step_batch(self, batch):
+    """Distributed training step on a batch."""
+    return self._distributed_step(batch)
+
+  def _distributed_step(self, batch):
+    """Run step_fn on each replica and return the averaged losses."""
+    losses = self.run(self._step_fn, batch)
+    return self._local_losses(losses)
+
+  def _accumulated_step(self, inputs):
+    """Accumulate gradients over several batches, then apply them once."""
+    for _ in tf.range(self.accum_steps - 1):
+      self.run(self._accumulate_step_fn, next(inputs))
+    losses = self.run(self._accumulate_step_fn, next(inputs))
+    # Report the losses of the last batch.
+    losses = self.run(self._apply_step_fn, losses)
+    return self._local_losses(losses)
+
+  def _local_losses(self, losses):
+    """Losses are already averaged across replicas, take the local copy."""
+    return tf.nest.map_structure(
+        lambda v: self.strategy.experimental_local_results(v)[0], losses)
+
   def step_fn(self, batch):
-    """Per-Replica training step."""
+    """Per-Replica training step, returns losses averaged across replicas."""
     with tf.GradientTape() as tape:
       _, losses = self.model(batch, return_losses=True, training=True)
-    # Clip and apply gradients.
-    grads = tape.gradient(losses['total_loss'], self.model.trainable_variables)
-    grads, _ = tf.clip_by_global_norm(grads, self.grad_clip_norm)
-    self.optimizer.apply_gradients(zip(grads, self.model.trainable_variables))
+      loss = self._scale_loss(losses['total_loss'])
+    grads = self._get_grads(tape, loss)
+    # Issue the loss all-reduce in-graph so it can overlap the update.
+    losses = self.replica_mean(losses)
+    self.apply_gradients(grads)
     return losses
 
+  def accumulate_step_fn(self, batch):
+    """Per-Replica step adding gradients to the local accumulators."""
+    with tf.GradientTape() as tape:
+      _, losses = self.model(batch, return_losses=True, training=True)
+      loss = self._scale_loss(losses['total_loss'])
+    grads = self._get_grads(tape, loss)
+    self._has_grad = [grad is not None for grad in grads]
+    for accumulator, grad in zip(self._grad_accumulators, grads):
+      if grad is not None:
+        accumulator.assign_add(grad)
+    return losses
+
+  def apply_step_fn(self, losses):
+    """Per-Replica step applying and resetting the accumulated gradients."""
+    losses = self.replica_mean(losses)
+    # Variables without a gradient get None, as in `step_fn`, instead of a zero
+    # gradient that would still move them with Adam's momentum.
+    grads = [a.read_value() / self.accum_steps if has_grad else None
+             for a, has_grad in zip(self._grad_accumulators, self._has_grad)]
+    self.apply_gradients(grads)
+    for accumulator in self._grad_accumulators:
+      accumulator.assign(tf.zeros_like(accumulator))
+    return losses
+
+  def apply_gradients(self, grads):
+    """Clip and apply gradients to the trainable variables."""
+    grads, _ = tf.clip_by_global_norm(grads, self.grad_clip_norm)
+    if self.all_reduce_dtype is not None:
+      grads = self.all_reduce_compressed(grads)
+    self.optimizer.apply_gradients(zip(grads, self._trainable_vars),
+                                   **self._apply_kwargs)
+
+  def all_reduce_compressed(self, grads):
+    """Sum gradients across replicas, sent as `all_reduce_dtype`."""
+    # Variables without a gradient stay None, as the optimizer expects.
+    idx = [i for i, g in enumerate(grads) if g is not None]
+    compressed = [tf.cast(grads[i], self.all_reduce_dtype) for i in idx]
+    replica_ctx = tf.distribute.get_replica_context()
+    reduced = replica_ctx.all_reduce(tf.distribute.ReduceOp.SUM, compressed)
+    grads = list(grads)
+    for i, g in zip(idx, reduced):
+      grads[i] = tf.cast(g, grads[i].dtype)
+    return grads
+
 
 @gin.configurable
 def get_trainer_class(trainer_class=Trainer):
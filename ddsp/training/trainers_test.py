@@ -0,0 +1,232 @@
+# Copyright 2022 The DDSP Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for ddsp.training.trainers."""
+
+import os
+
+from absl.testing import parameterized
+from ddsp.training import models
+from ddsp.training import train_util
+from ddsp.training import trainers
+import numpy as np
+import tensorflow.compat.v2 as tf
+
+tfkl = tf.keras.layers
+
+
+class LinearModel(models.Model):
+  """Linear regression model with a loss in each of two dtypes."""
+
+  def __init__(self, **kwargs):
+    super().__init__(**kwargs)
+    self.dense = tfkl.Dense(1, kernel_initializer='ones')
+
+  def call(self, batch, training=False):
+    y = self.dense(batch['x'])
+    target = tf.cast(batch['y'], y.dtype)
+    # One loss in the compute dtype, one always in float32.
+    self._losses_dict['mse_loss'] = tf.reduce_mean((y - target)**2)
+    self._losses_dict['l1_loss'] = tf.reduce_mean(
+        tf.abs(tf.cast(y - target, tf.float32)))
+    return {'y': y}
+
+  def get_audio_from_outputs(self, outputs):
+    return outputs['y']
+
+
+class LinearModelWithUnusedVariable(LinearModel):
+  """Linear model with a trainable variable that never gets a gradient."""
+
+  def __init__(self, **kwargs):
+    super().__init__(**kwargs)
+    self.unused = tf.Variable(1.0)
+
+
+def get_batch(n_batch, seed=0):
+  rng = np.random.RandomState(seed)
+  return {'x': tf.constant(rng.randn(n_batch, 3), tf.float32),
+          'y': tf.constant(rng.randn(n_batch, 1), tf.float32)}
+
+
+def get_dataset(n_batch, n_examples=8):
+  examples = get_batch(n_examples)
+  return tf.data.Dataset.from_tensor_slices(examples).batch(n_batch)
+
+
+class TrainerTest(parameterized.TestCase, tf.test.TestCase):
+
+  def get_trainer(self, strategy=None, model_class=LinearModel, **kwargs):
+    strategy = strategy or tf.distribute.MirroredStrategy()
+    with strategy.scope():
+      model = model_class()
+      trainer = trainers.Trainer(model, strategy, **kwargs)
+    return trainer
+
+  @parameterized.named_parameters(('graph', False), ('xla', True))
+  def test_build_and_train_step(self, jit_compile):
+    """Build on CPU, then train on full and partial batches."""
+    trainer = self.get_trainer(jit_compile=jit_compile)
+    # 4 + 4 + 3 examples, the last batch is partial.
+    dataset_iter = trainer.make_iterator(get_dataset(4, n_examples=11))
+    trainer.build(next(dataset_iter))
+    for _ in range(2):
+      losses = trainer.train_step()
+      self.assertSetEqual(set(losses.keys()),
+                          {'mse_loss', 'l1_loss', 'total_loss'})
+      self.assertTrue(np.isfinite(losses['total_loss'].numpy()))
+    self.assertEqual(int(trainer.step.numpy()), 2)
+
+  @parameterized.named_parameters(('graph', False), ('xla', True))
+  def test_default_strategy(self, jit_compile):
+    """Build and train with the default (no-op) distribution strategy."""
+    trainer = self.get_trainer(strategy=tf.distribute.get_strategy(),
+                               jit_compile=jit_compile)
+    dataset_iter = trainer.make_iterator(get_dataset(4))
+    trainer.build(next(dataset_iter))
+    losses = trainer.train_step()
+    self.assertTrue(np.isfinite(losses['total_loss'].numpy()))
+
+  def test_train_step_reuses_one_trace(self):
+    """Repeated train_step() calls on the trainer's iterator trace once."""
+    trainer = self.get_trainer()
+    dataset_iter = trainer.make_iterator(get_dataset(2, n_examples=8))
+    trainer.build(next(dataset_iter))
+    for _ in range(3):
+      trainer.train_step()
+    self.assertEqual(trainer._train_step_iter.experimental_get_tracing_count(),
+                     1)
+
+  def test_train_step_without_build_raises(self):
+    trainer = self.get_trainer()
+    trainer.make_iterator(get_dataset(2))
+    with self.assertRaisesRegex(ValueError, 'build'):
+      trainer.train_step()
+
+  def test_train_step_without_iterator_raises(self):
+    trainer = self.get_trainer()
+    trainer.build(get_batch(2))
+    with self.assertRaises(ValueError):
+      trainer.train_step()
+
+  @parameterized.named_parameters(('iterator', True), ('batch', False))
+  def test_deprecated_train_step_inputs(self, pass_iterator):
+    """Passing an iterator or a batch to train_step() still trains."""
+    trainer = self.get_trainer()
+    dataset = trainer.distribute_dataset(get_dataset(2))
+    dataset_iter = iter(dataset)
+    trainer.build(next(dataset_iter))
+    inputs = dataset_iter if pass_iterator else next(dataset_iter)
+    losses = trainer.train_step(inputs)
+    self.assertIn('total_loss', losses)
+    self.assertEqual(int(trainer.step.numpy()), 1)
+
+  def test_accumulation_averages_gradients(self):
+    """Accumulating 2 half batches averages to the full batch gradient."""
+    full_batch = get_batch(4)
+    half_batches = [{k: v[:2] for k, v in full_batch.items()},
+                    {k: v[2:] for k, v in full_batch.items()}]
+
+    # Reference gradient on the full batch, from identically initialized vars.
+    model = LinearModel()
+    with tf.GradientTape() as tape:
+      _, losses = model(full_batch, return_losses=True, training=True)
+    full_grads = tape.gradient(losses['total_loss'], model.trainable_variables)
+
+    trainer = self.get_trainer(accum_steps=2)
+    trainer.build(half_batches[0])
+    for batch in half_batches:
+      losses = trainer.run(trainer._accumulate_step_fn, batch)
+    for accumulator, full_grad in zip(trainer._grad_accumulators, full_grads):
+      self.assertAllClose(accumulator / trainer.accum_steps, full_grad)
+
+    # Applying the update resets the accumulators.
+    trainer.run(trainer._apply_step_fn, losses)
+    self.assertEqual(int(trainer.step.numpy()), 1)
+    for accumulator in trainer._grad_accumulators:
+      self.assertAllEqual(accumulator, tf.zeros_like(accumulator))
+
+  @parameterized.named_parameters(('single_step', 1), ('accumulate', 2))
+  def test_no_gradient_applies_none(self, accum_steps):
+    """Variables without a gradient are passed None, not a zero gradient."""
+    trainer = self.get_trainer(model_class=LinearModelWithUnusedVariable,
+                               accum_steps=accum_steps)
+    applied = []
+    apply_gradients = trainer.apply_gradients
+
+    def recording_apply_gradients(grads):
+      applied.append([g is None for g in grads])
+      apply_gradients(grads)
+
+    trainer.apply_gradients = recording_apply_gradients
+    dataset_iter = trainer.make_iterator(get_dataset(2))
+    trainer.build(next(dataset_iter))
+    trainer.train_step()
+
+    unused_index = [v is trainer.model.unused
+                    for v in trainer._trainable_vars].index(True)
+    expected = [i == unused_index for i in range(len(trainer._trainable_vars))]
+    self.assertEqual(applied[-1], expected)
+    self.assertEqual(float(trainer.model.unused.numpy()), 1.0)
+
+  def test_mixed_precision_train_step(self):
+    """One step runs with mixed bfloat16 and float32 losses."""
+    train_util.set_precision_policy('mixed_bfloat16')
+    try:
+      trainer = self.get_trainer()
+      dataset_iter = trainer.make_iterator(get_dataset(4))
+      trainer.build(next(dataset_iter))
+      losses = trainer.train_step()
+    finally:
+      train_util.set_precision_policy('float32')
+    self.assertEqual(losses['total_loss'].dtype, tf.float32)
+    self.assertTrue(np.isfinite(losses['total_loss'].numpy()))
+
+  def test_stage_checkpoint_keeps_only_latest(self):
+    """Staging a checkpoint removes only the previously staged checkpoint."""
+    ckpt_dir = self.create_tempdir().full_path
+    staging_dir = self.create_tempdir().full_path
+    for step in (1, 2):
+      for suffix in ('.index', '.data-00000-of-00001'):
+        path = os.path.join(ckpt_dir, f'ckpt-{step}{suffix}')
+        with tf.io.gfile.GFile(path, 'w') as f:
+          f.write(f'{step}')
+    # Files not created by the trainer are never deleted.
+    other_path = os.path.join(staging_dir, 'other-process')
+    with tf.io.gfile.GFile(other_path, 'w') as f:
+      f.write('keep')
+
+    trainer = self.get_trainer(restore_staging_dir=staging_dir)
+    staged_prefixes = []
+    for step in (1, 2):
+      staged_prefix = trainer._stage_checkpoint(
+          os.path.join(ckpt_dir, f'ckpt-{step}'))
+      staged_prefixes.append(staged_prefix)
+      self.assertEqual(os.path.basename(staged_prefix), f'ckpt-{step}')
+      self.assertEqual(os.path.dirname(os.path.dirname(staged_prefix)),
+                       staging_dir)
+      self.assertTrue(tf.io.gfile.exists(staged_prefix + '.index'))
+      self.assertTrue(
+          tf.io.gfile.exists(staged_prefix + '.data-00000-of-00001'))
+
+    self.assertFalse(tf.io.gfile.exists(os.path.dirname(staged_prefixes[0])))
+    self.assertTrue(tf.io.gfile.exists(other_path))
+
+  def test_invalid_accum_steps_raises(self):
+    with self.assertRaises(ValueError):
+      self.get_trainer(accum_steps=0)
+
+
+if __name__ == '__main__':
+  tf.test.main()